@@ -0,0 +1,210 @@
+"""A phue Bridge talking to the Hue bridge over persistent HTTP connections."""
+
+import json
+import time
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
+
+import phue
+
+
+logger = logging.getLogger()
+
+TIMEOUT = 5  # in seconds, better fail fast than hang until the next cron.
+MAX_WORKERS = 8  # requests in flight, the bridge handles around 10 per second.
+IDEMPOTENT = {"GET", "PUT", "DELETE"}  # Safe to send twice.
+
+
+class Throttle:
+    """A token bucket, allowing `rate` acquisitions per second, in
+    bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token to be available, and take it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last) * self.rate
+            )
+            self.last = now
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+                time.sleep(wait)
+                self.tokens = 1
+                self.last = now + wait
+            self.tokens -= 1
+
+
+class Bridge(phue.Bridge):
+    """Like phue.Bridge, but keeps its connections open between requests.
+
+    phue opens (and closes) a new TCP connection for each request,
+    costing a round-trip per light command. Each thread gets its own
+    connection, as lights given as a list to set_light are set
+    concurrently.
+
+    Commands are throttled to the documented limits of the bridge:
+    around 10 per second for lights, and 1 per second for groups.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        self._executor = None
+        self._throttles = {"lights": Throttle(10, 10), "groups": Throttle(1, 1)}
+        super().__init__(*args, **kwargs)
+
+    @property
+    def _connection(self):
+        return getattr(self._local, "connection", None)
+
+    @_connection.setter
+    def _connection(self, connection):
+        self._local.connection = connection
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _throttle(self, mode, address):
+        if mode != "PUT":
+            return
+        for resource, throttle in self._throttles.items():
+            if address.startswith(f"/api/{self.username}/{resource}/"):
+                throttle.acquire()
+
+    def request(self, mode="GET", address=None, data=None):
+        self._throttle(mode, address)
+        body = None if data is None else json.dumps(data)
+        if mode not in IDEMPOTENT:
+            # Can't be retried, so don't risk an idle connection.
+            self._close()
+        while True:
+            reused = self._connection is not None
+            if not reused:
+                self._connection = HTTPConnection(self.ip, timeout=TIMEOUT)
+            try:
+                self._connection.request(mode, address, body)
+                response = self._connection.getresponse().read()
+                break
+            except socket.timeout as err:
+                self._close()
+                raise phue.PhueRequestTimeout(
+                    None, f"{mode} request to {self.ip}{address} timed out."
+                ) from err
+            except (HTTPException, ConnectionError):
+                self._close()
+                # The bridge may have closed our idle connection, retry
+                # on a new one, unless the request may have been handled.
+                if not reused or mode not in IDEMPOTENT:
+                    raise
+        logger.debug("%s %s %s", mode, address, body)
+        return json.loads(response.decode("utf-8"))
+
+    def set_light(self, light_id, parameter, value=None, transitiontime=None):
+        """Like phue.Bridge.set_light, but a list of lights is set
+        concurrently instead of one light after the other."""
+        if isinstance(light_id, (int, str)) or len(light_id) < 2:
+            return super().set_light(light_id, parameter, value, transitiontime)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        results = self._executor.map(
+            lambda one: super(Bridge, self).set_light(
+                one, parameter, value, transitiontime
+            ),
+            light_id,
+        )
+        return [result for light_results in results for result in light_results]
+
+
+def test_throttle(monkeypatch):
+    import pytest
+
+    clock = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(time, "sleep", sleep)
+
+    lights = Throttle(rate=10, capacity=10)
+    for _ in range(10):
+        lights.acquire()
+    assert sleeps == []  # A full burst goes through.
+    lights.acquire()
+    assert sleeps == [pytest.approx(0.1)]
+    clock[0] += 1  # A second later, the bucket is full again.
+    for _ in range(10):
+        lights.acquire()
+    assert len(sleeps) == 1
+
+    groups = Throttle(rate=1, capacity=1)
+    groups.acquire()
+    groups.acquire()
+    groups.acquire()
+    assert sleeps[1:] == [pytest.approx(1), pytest.approx(1)]
+
+
+def test_request_retries(monkeypatch):
+    import pytest
+    from http.client import RemoteDisconnected
+
+    sent = []
+    failures = []
+
+    class Connection:
+        """Fails the next requests with the exceptions in failures."""
+
+        def __init__(self, host, timeout):
+            pass
+
+        def request(self, mode, address, body):
+            sent.append((mode, self))
+            if failures:
+                raise failures.pop(0)
+
+        def getresponse(self):
+            return self
+
+        def read(self):
+            return b"[]"
+
+        def close(self):
+            pass
+
+    monkeypatch.setitem(globals(), "HTTPConnection", Connection)
+    bridge = Bridge("10.0.0.7", "u")
+
+    # The bridge closed our idle connection: a PUT is sent again, once.
+    bridge.request("PUT", "/api/u/config", {})
+    failures.append(RemoteDisconnected())
+    assert bridge.request("PUT", "/api/u/config", {}) == []
+    assert [mode for mode, _ in sent] == ["PUT", "PUT", "PUT"]
+    assert sent[0][1] is sent[1][1] is not sent[2][1]
+
+    # A POST may have been handled, it's never sent twice.
+    sent.clear()
+    failures.append(RemoteDisconnected())
+    with pytest.raises(RemoteDisconnected):
+        bridge.request("POST", "/api/u/groups/", {})
+    assert [mode for mode, _ in sent] == ["POST"]
+
+    # Failing on a new connection is not about an idle connection.
+    sent.clear()
+    failures.append(ConnectionResetError())
+    with pytest.raises(ConnectionResetError):
+        bridge.request("PUT", "/api/u/config", {})
+    assert [mode for mode, _ in sent] == ["PUT"]
@@ -1,22 +1,34 @@
 """Control a living room.
 
-python hue.py Paris --hue-bridge 10.0.0.7 --sensors 'Salon Entrée' 'Salon Four' 'Salon' 'Salon Fenetre' 'Salon Frigo' --lights 'Salon 1-1' 'Salon 1-2' 'Salon 1-3' 'Salon 1-4' 'Salon 1-5' 'Salon 2-1' 'Salon 2-2' 'Salon 2-3' 'Salon 2-4' 'Salon 2-5' 'Cuisine'
+hue-room-control Paris --hue-bridge 10.0.0.7 --sensors 'Salon Entrée' 'Salon Four' 'Salon' 'Salon Fenetre' 'Salon Frigo' --lights 'Salon 1-1' 'Salon 1-2' 'Salon 1-3' 'Salon 1-4' 'Salon 1-5' 'Salon 2-1' 'Salon 2-2' 'Salon 2-3' 'Salon 2-4' 'Salon 2-5' 'Cuisine'
 """
 import sys
+import json
+import time
+import calendar
+import hashlib
 import argparse
 import logging
-from datetime import datetime, timezone, timedelta
-from subprocess import run, PIPE
-
-from astral.geocoder import lookup, database
-import astral.sun
-from phue import Bridge
-from tabulate import tabulate
-from huetils.utils import illumination, interpolate
+from datetime import datetime, timezone
+
+from huetils.utils import (
+    CACHE_DIR,
+    Sun,
+    get_city,
+    illumination,
+    interpolate,
+    weather,
+    write_cache,
+)
 
 logger = logging.getLogger()
 
 PERIOD = 10  # in minutes, duration between two start of the script.
+TRANSITION = PERIOD * 60 * 10  # in deciseconds, as expected by the bridge.
+GROUPS_CACHE = CACHE_DIR / "groups.json"
+GROUP_PREFIX = "huetils "  # Names of the groups created by huetils.
+GROUP_TTL = 7 * 24 * 3600  # in seconds, huetils groups unused longer are deleted.
+TOLERANCE = 3  # in bri or mireds, below which a change is not worth a request.
 
 
 def parse_args():
@@ -45,187 +57,492 @@ def parse_args():
     return parser.parse_args()
 
 
-def list_sensors(bridge):
+def print_table(table):
+    """Print a table, aligned for humans, tab separated for scripts."""
+    if not sys.stdout.isatty():
+        for line in table:
+            print(*line, sep="\t")
+        return
+    from tabulate import tabulate
+
+    print(tabulate(table))
+
+
+def list_sensors(sensors):
     """List all sensors ordered by last push.
 
     So it's easy for a human to build a --sensors from this."""
     table = []
-    for sensor in bridge.sensors:
-        table.append((sensor.name, sensor.state["lastupdated"]))
-    print(tabulate(sorted(table, key=lambda line: line[1], reverse=True)))
+    for sensor in sensors.values():
+        table.append((sensor["name"], sensor["state"].get("lastupdated", "")))
+    print_table(sorted(table, key=lambda line: line[1], reverse=True))
 
 
-def list_lights(bridge):
+def list_lights(lights, groups):
     """List all lights by group.
 
     So it's easy for a human to build a --lights from this."""
     table = []
     reverse_group = {}
-    for group in bridge.groups:
-        for light in group.lights:
-            reverse_group[light.name] = group.name
-    for light in bridge.lights:
-        table.append((light.name, reverse_group.get(light.name, "")))
-    print(tabulate(sorted(table, key=lambda line: line[1], reverse=True)))
+    for group in groups.values():
+        if group["name"].startswith(GROUP_PREFIX):
+            continue  # Not a Room or a Zone, see light_group.
+        for light_id in group["lights"]:
+            reverse_group[light_id] = group["name"]
+    for light_id, light in lights.items():
+        table.append((light["name"], reverse_group.get(light_id, "")))
+    print_table(sorted(table, key=lambda line: line[1], reverse=True))
 
 
-def sensor_pressed_not_long_ago(bridge, sensors_to_watch):
+def sensor_pressed_not_long_ago(sensors, sensors_to_watch):
     """Watch sensors, tell if one of them has been pressed."""
-    now = datetime.now(timezone.utc)
-    for sensor in bridge.sensors:
-        if sensor.name not in sensors_to_watch:
+    now = time.time()
+    watch = frozenset(sensors_to_watch or ())
+    for sensor in sensors.values():
+        if sensor["name"] not in watch:
+            continue
+        lastupdated = sensor["state"].get("lastupdated", "none")
+        if lastupdated == "none":  # Never been pressed.
+            continue
+        # The bridge gives UTC times, without timezone.
+        pressed = calendar.timegm(time.strptime(lastupdated, "%Y-%m-%dT%H:%M:%S"))
+        if now - pressed < 60 * 60:
+            logging.info("Sensor %s pressed not long ago...", sensor["name"])
+            return True
+
+
+def group_name(key):
+    """Name of the huetils group for the given GROUPS_CACHE key."""
+    return GROUP_PREFIX + hashlib.sha1(key.encode()).hexdigest()[:8]
+
+
+def read_groups_cache():
+    """Read GROUPS_CACHE, giving {key: {"id": group_id, "used": timestamp}}."""
+    try:
+        cache = json.loads(GROUPS_CACHE.read_text())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return {
+        key: entry
+        for key, entry in cache.items()
+        if isinstance(entry, dict) and {"id", "used"} <= entry.keys()
+    }
+
+
+def delete_unused_groups(bridge, cache, now):
+    """Delete the huetils groups of this bridge unused for GROUP_TTL,
+    like after a change of --lights, so they don't fill the bridge."""
+    for key, entry in list(cache.items()):
+        if not key.startswith(f"{bridge.ip}/") or now - entry["used"] < GROUP_TTL:
             continue
-        pressed = datetime.fromisoformat(sensor.state["lastupdated"] + "+00:00")
-        elapsed_since_pressed = now - pressed
-        if elapsed_since_pressed < timedelta(minutes=60):
-            logging.info("Sensor %s pressed not long ago...", sensor.name)
+        del cache[key]
+        group = bridge.get_group(entry["id"])
+        if isinstance(group, dict) and group.get("name") == group_name(key):
+            logger.info("Deleting unused group %s (%s)", entry["id"], group_name(key))
+            bridge.delete_group(entry["id"])
+
+
+def light_group(bridge, lights):
+    """Find, or create, the huetils group containing exactly the given
+    lights (a dict of lights by id, as returned by the bridge).
+
+    Setting the state of a group is a single request, the bridge then
+    fans out to the lights. Only groups created by huetils are used, a
+    user's Room or Zone may get other lights later. The group id is
+    cached in GROUPS_CACHE, and checked on each use.
+
+    Returns None if the bridge refuses to create the group.
+    """
+    light_ids = sorted(lights)
+    key = f"{bridge.ip}/{','.join(light_ids)}"
+    name = group_name(key)
+    now = time.time()
+    cache = read_groups_cache()
+    if key in cache:
+        cache[key]["used"] = now
+    delete_unused_groups(bridge, cache, now)
+    group_id = cache.get(key, {}).get("id")
+    group = None if group_id is None else bridge.get_group(group_id)
+    if not isinstance(group, dict) or group.get("name") != name:
+        for group_id, group in bridge.get_group().items():
+            if group.get("name") == name:
+                logger.info("Using group %s (%s)", group_id, name)
+                break
+        else:
+            result = bridge.create_group(name, light_ids)
+            if "error" in result[0]:
+                logger.warning(
+                    "Can't create group %s: %s",
+                    name,
+                    result[0]["error"]["description"],
+                )
+                return None
+            group_id = result[0]["success"]["id"]
+            group = {"lights": light_ids}
+            logger.info("Created group %s (%s)", group_id, name)
+    if sorted(group.get("lights", ())) != light_ids:
+        logger.info("Setting the lights of group %s (%s)", group_id, name)
+        bridge.set_group(int(group_id), "lights", light_ids)
+    cache[key] = {"id": int(group_id), "used": now}
+    write_cache(GROUPS_CACHE, json.dumps(cache).encode())
+    return cache[key]["id"]
+
+
+def set_lights_state(bridge, lights, state):
+    """Set the state of all given lights at once, using a group.
+
+    Falls back to setting each light if there's no group for them."""
+    if not lights:
+        return
+    group_id = light_group(bridge, lights)
+    if group_id is None:
+        bridge.set_light([int(light_id) for light_id in lights], state)
+    else:
+        bridge.set_group(group_id, state)
+
+
+def need_update(lights, parameter, target):
+    """Tell if at least one of the lights which are on is not at target yet.
+
+    A color light in xy or hs mode keeps a stale "ct", so it is only at
+    the target "ct" when in "ct" colormode.
+    """
+    for light in lights.values():
+        state = light["state"]
+        if not state["on"] or parameter not in state:
+            continue
+        if parameter == "ct" and state.get("colormode") != "ct":
+            return True
+        if abs(state[parameter] - target) >= TOLERANCE:
             return True
+    return False
+
+
+def target_state(lights, parameter, target):
+    """Build the group state moving lights to target.
+
+    Empty if they already are there."""
+    if not need_update(lights, parameter, target):
+        logger.info("Lights already at %s=%s.", parameter, target)
+        return {}
+    return {parameter: target}
+
+
+def switch_lights(bridge, lights, light_ids, state):
+    """Set the state of each given light, keeping lights up to date."""
+    if not light_ids:
+        return
+    bridge.set_light([int(light_id) for light_id in light_ids], state)
+    for light_id in light_ids:
+        lights[light_id]["state"].update(state)
 
 
 def poweroff_lights(bridge, lights):
-    """Slowly power off given lights."""
-    logger.info("Need to power off lights %s", lights)
-    for light in lights:
-        if not light.on:
-            logger.info("Light %s already off.", light.name)
+    """Slowly power off given lights.
+
+    Lights at lowest brightness are switched off right away, the group
+    state dimming down the others is returned."""
+    logger.info(
+        "Need to power off lights %s", [light["name"] for light in lights.values()]
+    )
+    need_dimming = False
+    to_power_off = []
+    for light_id, light in lights.items():
+        if not light["state"]["on"]:
+            logger.info("Light %s already off.", light["name"])
             continue
-        if light.brightness <= 1:
-            logger.info("Light %s is at lowest brightness, powering off.", light.name)
-            light.on = False
+        if light["state"]["bri"] <= 1:
+            logger.info(
+                "Light %s is at lowest brightness, powering off.", light["name"]
+            )
+            to_power_off.append(light_id)
         else:
             logger.info(
                 "Light %s is at bri=%s, will slowly dim down",
-                light.name,
-                light.brightness,
+                light["name"],
+                light["state"]["bri"],
             )
-            bridge.set_light(light.light_id, "bri", 0, transitiontime=PERIOD * 60 * 10)
+            need_dimming = True
+    switch_lights(bridge, lights, to_power_off, {"on": False})
+    # Lights already off are left untouched by a group "bri" action.
+    return {"bri": 0} if need_dimming else {}
 
 
 def poweron_lights(bridge, lights, illum):
-    """Slowly power on given lights."""
+    """Slowly power on given lights.
+
+    Lights which are off are switched on right away at lowest
+    brightness, the group state dimming them up is returned."""
     target = int(interpolate(illum, 255, 0))
-    for light in lights:
-        if not light.on:
-            logger.info("Light %s is off, powering on.", light.name)
-            light.on = True
-            light.brightness = 0
-        logger.info(
-            "Light %s is at bri=%s, will slowly dim to %s",
-            light.name,
-            light.brightness,
-            target,
-        )
-        bridge.set_light(light.light_id, "bri", target, transitiontime=PERIOD * 60 * 10)
-
-
-def set_lights_brightness(bridge, now, lights, sun, only_switchoff=False):
-    """Set lights brightness according to sun position."""
-    illum = illumination(now, sun)
+    to_power_on = []
+    for light_id, light in lights.items():
+        if not light["state"]["on"]:
+            logger.info("Light %s is off, powering on.", light["name"])
+            to_power_on.append(light_id)
+        else:
+            logger.info(
+                "Light %s is at bri=%s, will slowly dim to %s",
+                light["name"],
+                light["state"]["bri"],
+                target,
+            )
+    switch_lights(bridge, lights, to_power_on, {"on": True, "bri": 0})
+    return target_state(lights, "bri", target)
+
+
+def set_lights_brightness(bridge, now, lights, illum, only_switchoff=False):
+    """Set lights brightness according to sun illumination.
+
+    Returns the group state to apply to the lights."""
     if illum == 1:
         logger.info("It's the day!")
-        poweroff_lights(bridge, lights)
-        return
+        return poweroff_lights(bridge, lights)
     # If we're here, it's the night
     if 0 < now.hour < 7:
         logger.info("It's the night, everybody asleep.")
         # From 1AM to 7AM, lights should better be off.
-        poweroff_lights(bridge, lights)
-        return
+        return poweroff_lights(bridge, lights)
     # If we're here it's the night but someone may be up!
     if only_switchoff:
-        return
+        return {}
     logger.info(
         f"It's not the day, illumination is at {illum:.0%}, switching on lights."
     )
-    poweron_lights(bridge, lights, illum)
+    return poweron_lights(bridge, lights, illum)
 
 
-def transition_to_ct(bridge, lights, ct):
-    for light in lights:
-        bridge.set_light(light.light_id, "ct", ct, transitiontime=PERIOD * 60 * 10)
-
-
-def redshift(bridge, now, lights, sun):
+def redshift(now, lights, sun):
     """Shift color temperature according to time of the day.
 
+    Returns the group state to apply to the lights.
+
     During the morning we shift from hottest to coldest from dawn to sunrise.
     During the evening we shift from coldest to hottest from sunset to dusk + 3h.
     """
     coldest = 153  # in mireds.
     hottest = 500  # in mireds.
-    sun = sun.copy()
-    sun["dusk"] = sun["dusk"] + timedelta(hours=3)
-    illum = illumination(now, sun)
+    sun = sun._replace(dusk=sun.dusk + 3 * 3600)
+    illum = illumination(now.timestamp(), sun)
     if illum == 1:
         logger.info("It's daytime, transition to coldest temp.")
-        transition_to_ct(bridge, lights, coldest)
-        return
+        return target_state(lights, "ct", coldest)
     if illum == 0:
         logger.info("It's nighttime, transition to hottest temp.")
-        transition_to_ct(bridge, lights, hottest)
-        return
+        return target_state(lights, "ct", hottest)
     target = int(interpolate(illum, hottest, coldest))
     logger.info(
         f"[redshift] It's transition time ({illum:.0%}), set mireds={target} "
         "(132 is cold, 500 is hot)",
     )
-    transition_to_ct(bridge, lights, target)
+    return target_state(lights, "ct", target)
 
 
 def check_if_cloudy(latitude, longitude):
-    sky_conditions = run(
-        ["weather", "--headers", "Sky conditions", "-q", f"{latitude},{longitude}"],
-        stdout=PIPE,
-        check=True,
-        encoding="UTF-8",
-    ).stdout.strip()
+    sky_conditions = weather(
+        "--headers", "Sky conditions", "-q", f"{latitude},{longitude}"
+    ).strip()
     logger.info(sky_conditions)
     return any(bad in sky_conditions for bad in ("cloudy", "overcast"))
 
 
 def main():
     args = parse_args()
+    # Imported here, so the --help does not pay for it.
+    from huetils.bridge import Bridge
+
     bridge = Bridge(args.hue_bridge)
     bridge.connect()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    # Lights and sensors are read once, in bulk: phue objects issue a
+    # GET per attribute. The whole config (get_api) would also bring
+    # scenes, rules, and schedules we don't need.
     if args.list_sensors:
-        list_sensors(bridge)
+        list_sensors(bridge.get_sensor())
         sys.exit(0)
     if args.list_lights:
-        list_lights(bridge)
+        list_lights(bridge.get_light(), bridge.get_group())
         sys.exit(0)
-    if sensor_pressed_not_long_ago(bridge, args.sensors):
+    if sensor_pressed_not_long_ago(bridge.get_sensor(), args.sensors):
         logger.info("Sensor pressed not long ago, leaving.")
         return
-    city = lookup(args.city, database())
+    city = get_city(args.city)
     is_cloudy = check_if_cloudy(city.latitude, city.longitude)
     if args.now:
         now = datetime.fromisoformat(args.now).astimezone().astimezone(timezone.utc)
     else:
         now = datetime.now(timezone.utc)
-    sun = astral.sun.sun(city.observer, date=now.date())
-    controlled_lights = [light for light in bridge.lights if light.name in args.lights]
+    sun = Sun.of(city, now.date())
+    lights = bridge.get_light()
+    lights_by_name = {light["name"]: light_id for light_id, light in lights.items()}
+    controlled_lights = {}
+    for name in args.lights or ():
+        if name not in lights_by_name:
+            logger.warning("No light named %s on the bridge.", name)
+            continue
+        controlled_lights[lights_by_name[name]] = lights[lights_by_name[name]]
     logger.info("Information for %s/%s", city.name, city.region)
     logger.info("Timezone: %s", city.timezone)
 
-    def log_hour(date):
-        return date.astimezone().strftime("%H:%M")
+    def log_hour(timestamp):
+        return datetime.fromtimestamp(timestamp).strftime("%H:%M")
 
-    logger.info(f"Now: {log_hour(now)}")
-    logger.info(f"Dawn: {log_hour(sun['dawn'])}")
-    logger.info(f"Sunrise: {log_hour(sun['sunrise'])}")
-    logger.info(f"Sunset: {log_hour(sun['sunset'])}")
-    logger.info(f"Dusk: {log_hour(sun['dusk'])}")
+    logger.info(f"Now: {log_hour(now.timestamp())}")
+    logger.info(f"Dawn: {log_hour(sun.dawn)}")
+    logger.info(f"Sunrise: {log_hour(sun.sunrise)}")
+    logger.info(f"Sunset: {log_hour(sun.sunset)}")
+    logger.info(f"Dusk: {log_hour(sun.dusk)}")
     if is_cloudy:
         logger.info("Sky being cloudy, power on 30m sooner, as if:")
-        sun["sunset"] = sun["sunset"] - timedelta(minutes=30)
-        sun["dusk"] = sun["dusk"] - timedelta(minutes=30)
-        logger.info(f"Sunset: {log_hour(sun['sunset'])}")
-        logger.info(f"Dusk: {log_hour(sun['dusk'])}")
-    set_lights_brightness(
-        bridge, now, controlled_lights, sun, only_switchoff=args.only_switchoff
+        sun = sun._replace(sunset=sun.sunset - 30 * 60, dusk=sun.dusk - 30 * 60)
+        logger.info(f"Sunset: {log_hour(sun.sunset)}")
+        logger.info(f"Dusk: {log_hour(sun.dusk)}")
+    target = set_lights_brightness(
+        bridge,
+        now,
+        controlled_lights,
+        illumination(now.timestamp(), sun),
+        only_switchoff=args.only_switchoff,
     )
-    redshift(bridge, now, controlled_lights, sun)
+    target.update(redshift(now, controlled_lights, sun))
+    if target:
+        # A single request for both brightness and color temperature.
+        target["transitiontime"] = TRANSITION
+        set_lights_state(bridge, controlled_lights, target)
+
+
+def test_light_group(monkeypatch, tmp_path):
+    class Bridge:
+        """Records requests, like a bridge holding a Room."""
+
+        ip = "10.0.0.7"
+
+        def __init__(self):
+            self.groups = {"1": {"name": "Salon", "lights": ["1", "2", "3"]}}
+            self.calls = []
+
+        def get_group(self, group_id=None):
+            self.calls.append(("GET", group_id))
+            if group_id is None:
+                return self.groups
+            return self.groups.get(str(group_id), [{"error": {"type": 3}}])
+
+        def set_group(self, group_id, parameter, value=None):
+            if value is not None:
+                parameter = {parameter: value}
+                self.groups[str(group_id)].update(parameter)
+            self.calls.append(("PUT", group_id, parameter))
+
+        def set_light(self, light_id, parameter):
+            self.calls.append(("PUT", light_id, parameter))
+
+        def create_group(self, name, lights):
+            self.calls.append(("POST", name, lights))
+            if len(self.groups) >= 64:
+                return [{"error": {"type": 301, "description": "table full"}}]
+            group_id = str(max(map(int, self.groups)) + 1)
+            self.groups[group_id] = {"name": name, "lights": lights}
+            return [{"success": {"id": group_id}}]
+
+        def delete_group(self, group_id):
+            self.calls.append(("DELETE", group_id))
+            del self.groups[str(group_id)]
+
+    monkeypatch.setitem(globals(), "GROUPS_CACHE", tmp_path / "groups.json")
+    bridge = Bridge()
+    lights = {"1": {}, "2": {}}
+    name = group_name("10.0.0.7/1,2")
+
+    # The Room holds another light, so a group gets created.
+    set_lights_state(bridge, lights, {"bri": 10})
+    assert bridge.groups["2"] == {"name": name, "lights": ["1", "2"]}
+    assert bridge.calls == [
+        ("GET", None),
+        ("POST", name, ["1", "2"]),
+        ("PUT", 2, {"bri": 10}),
+    ]
+
+    # Cached: one GET to check the group, and one PUT.
+    bridge.calls = []
+    set_lights_state(bridge, lights, {"bri": 20})
+    assert bridge.calls == [("GET", 2), ("PUT", 2, {"bri": 20})]
+
+    # Someone changed the lights of our group: they're set back.
+    bridge.groups["2"]["lights"] = ["1"]
+    bridge.calls = []
+    set_lights_state(bridge, lights, {"bri": 30})
+    assert bridge.calls == [
+        ("GET", 2),
+        ("PUT", 2, {"lights": ["1", "2"]}),
+        ("PUT", 2, {"bri": 30}),
+    ]
+
+    # The cached id is now someone else's group: ours is found by name.
+    bridge.groups["3"] = bridge.groups.pop("2")
+    bridge.groups["2"] = {"name": "Cuisine", "lights": ["1", "2"]}
+    bridge.calls = []
+    set_lights_state(bridge, lights, {"bri": 40})
+    assert bridge.calls == [("GET", 2), ("GET", None), ("PUT", 3, {"bri": 40})]
+    assert json.loads(GROUPS_CACHE.read_text())["10.0.0.7/1,2"]["id"] == 3
+
+    # Another group, unused for too long, is deleted.
+    set_lights_state(bridge, {"1": {}}, {"bri": 50})
+    assert group_name("10.0.0.7/1") in [g["name"] for g in bridge.groups.values()]
+    monkeypatch.setattr(time, "time", lambda: GROUP_TTL + 2e9)
+    bridge.calls = []
+    set_lights_state(bridge, lights, {"bri": 60})
+    assert bridge.calls == [
+        ("GET", 4),
+        ("DELETE", 4),
+        ("GET", 3),
+        ("PUT", 3, {"bri": 60}),
+    ]
+
+    # No room left on the bridge: each light is set.
+    GROUPS_CACHE.unlink()
+    bridge.groups = {str(group_id): {} for group_id in range(1, 65)}
+    bridge.calls = []
+    set_lights_state(bridge, lights, {"bri": 70})
+    assert bridge.calls == [
+        ("GET", None),
+        ("POST", name, ["1", "2"]),
+        ("PUT", [1, 2], {"bri": 70}),
+    ]
+
+
+def test_need_update():
+    class Bridge:
+        def __init__(self):
+            self.calls = []
+
+        def set_light(self, light_id, parameter):
+            self.calls.append(("PUT", light_id, parameter))
+
+    lights = {
+        "1": {"name": "L1", "state": {"on": True, "bri": 254, "ct": 500}},
+        "2": {"name": "L2", "state": {"on": True, "bri": 253, "ct": 498}},
+        "3": {"name": "L3", "state": {"on": False, "bri": 1, "ct": 153}},
+    }
+    for light in lights.values():
+        light["state"]["colormode"] = "ct"
+    assert not need_update(lights, "bri", 255)
+    assert need_update(lights, "bri", 250)
+    assert not need_update(lights, "ct", 500)
+    assert need_update(lights, "ct", 153)
+
+    # Lights on and already at target: no request at all.
+    del lights["3"]
+    bridge = Bridge()
+    target = poweron_lights(bridge, lights, 0)
+    target.update(target_state(lights, "ct", 500))
+    assert target == {}
+    assert bridge.calls == []
+
+    # A color light in xy or hs colormode keeps a stale "ct".
+    lights["2"]["state"]["colormode"] = "xy"
+    assert need_update(lights, "ct", 500)
+    assert not need_update(lights, "bri", 255)
 
 
 if __name__ == "__main__":
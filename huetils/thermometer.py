@@ -4,13 +4,10 @@ reflect the outdoor temperature.
 Better run it in an hourly crontab.
 """
 
+import sys
 import argparse
-from subprocess import run, PIPE
 from datetime import datetime, timezone
-from phue import Bridge
-from astral.geocoder import lookup, database
-import astral.sun
-from huetils.utils import illumination, interpolate
+from huetils.utils import Sun, get_city, illumination, interpolate, weather
 
 
 def between(mini, maxi, color_start, color_end, current):
@@ -37,7 +34,14 @@ def degree_c_to_hue_color(temp):
        b = (40, 0)
        slope = (a[1] - b[1]) / (a[0] - b[0])
        y_intercept = 46920 - slope * -10  # b = y - mx
+
+    Values are looked up, per tenth of degree, in HUE_COLORS.
     """
+    return HUE_COLORS[max(0, min(500, round((temp + 10) * 10)))]
+
+
+def compute_hue_color(temp):
+    """Compute the hue color for a temperature, see degree_c_to_hue_color."""
     if temp < -10:
         return 46920
     if temp < 0:
@@ -51,6 +55,10 @@ def degree_c_to_hue_color(temp):
     return 56100
 
 
+# Hue color for each tenth of degree from -10°C to 40°C.
+HUE_COLORS = tuple(compute_hue_color(tenth / 10 - 10) for tenth in range(501))
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Bind temperature to hue color")
     parser.add_argument("--hue-bridge", help="Bridge IP address", required=True)
@@ -67,28 +75,42 @@ def parse_args():
 
 def main():
     args = parse_args()
+    from huetils.bridge import Bridge
+
     bridge = Bridge(args.hue_bridge)
     bridge.connect()
-    light = bridge.get_light(args.light)
-
-    if not light["state"]["on"]:
-        bridge.set_light(args.light, "on", True)
-    bridge.set_light(args.light, "sat", 255)
-    city = lookup(args.city, database())
+    # Resolved once: given a name, phue GETs all lights on each call.
+    lights = bridge.get_light()
+    lights_by_name = {light["name"]: light_id for light_id, light in lights.items()}
+    if args.light not in lights_by_name:
+        sys.exit(f"No light named {args.light} on the bridge.")
+    light_id = lights_by_name[args.light]
+    city = get_city(args.city)
     now = datetime.now(timezone.utc)
-    sun = astral.sun.sun(city.observer, date=now.date())
-    meteo = run(
-        ["weather", "--headers=temperature", "-m", "-q", args.weather],
-        stdout=PIPE,
-        check=True,
-        encoding="UTF-8",
-    ).stdout
+    sun = Sun.of(city, now.date())
+    meteo = weather("--headers=temperature", "-m", "-q", args.weather)
     degree = int(meteo.split()[1])
     if args.verbose:
         print(degree)
-    color = degree_c_to_hue_color(degree)
-    bridge.set_light(args.light, "hue", color)
-    bridge.set_light(args.light, "bri", interpolate(illumination(now, sun), 0, 255))
+    state = {
+        "sat": 255,
+        "hue": degree_c_to_hue_color(degree),
+        "bri": int(interpolate(illumination(now.timestamp(), sun), 0, 255)),
+    }
+    if not lights[light_id]["state"]["on"]:
+        state["on"] = True
+    bridge.set_light(int(light_id), state)
+
+
+def test_degree_c_to_hue_color():
+    assert degree_c_to_hue_color(-15) == 46920
+    assert degree_c_to_hue_color(-10) == 46920
+    assert degree_c_to_hue_color(0) == 25500
+    assert degree_c_to_hue_color(30) == 65280
+    assert degree_c_to_hue_color(40) == 56100
+    assert degree_c_to_hue_color(45) == 56100
+    for degree in range(-10, 41):
+        assert degree_c_to_hue_color(degree) == compute_hue_color(degree)
 
 
 if __name__ == "__main__":
@@ -1,29 +1,114 @@
+import os
+import time
+import pickle
+import hashlib
 import logging
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+from subprocess import run, PIPE
 
 
 logger = logging.getLogger()
 
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "huetils"
+WEATHER_TTL = 20 * 60  # in seconds, METAR reports are hourly anyway.
+
+
+def write_cache(cache_file, data: bytes):
+    """Write a file in CACHE_DIR, atomically as concurrent runs may read it."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}")
+    tmp_file.write_bytes(data)
+    tmp_file.replace(cache_file)
+
+
+def weather(*args) -> str:
+    """Run the `weather` command (from weather-util), give its output.
+
+    The output is cached for WEATHER_TTL seconds, so rooms controlled
+    from the same crontab don't each fetch the same report.
+    """
+    key = hashlib.sha1(" ".join(args).encode()).hexdigest()[:16]
+    cache_file = CACHE_DIR / f"weather_{key}.txt"
+    try:
+        if time.time() - cache_file.stat().st_mtime < WEATHER_TTL:
+            return cache_file.read_text(encoding="UTF-8")
+    except OSError:
+        pass
+    output = run(["weather", *args], stdout=PIPE, check=True, encoding="UTF-8").stdout
+    write_cache(cache_file, output.encode("UTF-8"))
+    return output
+
+
+@lru_cache(maxsize=None)
+def get_city(name):
+    """Lookup a city (like 'Paris') in the astral database.
+
+    The result is pickled in CACHE_DIR, so the database is only parsed
+    once per city. The astral version is part of the file name, so an
+    upgrade of astral never unpickles an older file.
+    """
+    import astral
+
+    key = hashlib.sha1(name.encode()).hexdigest()[:16]
+    cache_file = CACHE_DIR / f"city_{key}_astral-{astral.__version__}.pkl"
+    try:
+        with open(cache_file, "rb") as cache:
+            city = pickle.load(cache)
+        if isinstance(city, astral.LocationInfo):
+            return city
+    except Exception:  # Missing or unreadable, a lookup will rebuild it.
+        pass
+    from astral.geocoder import lookup, database
+
+    city = lookup(name, database())
+    write_cache(cache_file, pickle.dumps(city))
+    return city
+
+
+class Sun(namedtuple("Sun", "dawn sunrise sunset dusk")):
+    """Sun events of a day, as POSIX timestamps."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_astral(cls, sun):
+        """Build from the dict of datetimes given by astral.sun.sun."""
+        return cls(*(sun[event].timestamp() for event in cls._fields))
+
+    @classmethod
+    def of(cls, city, date):
+        """Sun events of the given date, in a city from get_city."""
+        import astral.sun
+
+        return cls.from_astral(astral.sun.sun(city.observer, date=date))
+
 
 def illumination(now, sun) -> float:
-    """Give the sun illumination.
+    """Give the sun illumination, now being a POSIX timestamp.
 
     0: It's still the night.
     0.x: Partial illumination between night and day or day and night.
     1: It's the day.
     """
-    if now < sun["dawn"] or now > sun["dusk"]:
-        return 0.0
-    if now < sun["sunrise"]:
-        return (now - sun["dawn"]).total_seconds() / (
-            sun["sunrise"] - sun["dawn"]
-        ).total_seconds()
-    if now > sun["sunset"]:
-        return (
-            1
-            - (now - sun["sunset"]).total_seconds()
-            / (sun["dusk"] - sun["sunset"]).total_seconds()
-        )
-    return 1
+    if now < sun.sunrise:
+        return min(max((now - sun.dawn) / (sun.sunrise - sun.dawn), 0.0), 1.0)
+    return 1.0 - min(max((now - sun.sunset) / (sun.dusk - sun.sunset), 0.0), 1.0)
+
+
+def illumination_array(now, sun):
+    """Like illumination, but for an array of POSIX timestamps.
+
+    Handy to compute the curve of a whole day, needs numpy (which is
+    not required by huetils).
+    """
+    import numpy as np
+
+    now = np.asarray(now, dtype=float)
+    morning = np.clip((now - sun.dawn) / (sun.sunrise - sun.dawn), 0.0, 1.0)
+    evening = 1.0 - np.clip((now - sun.sunset) / (sun.dusk - sun.sunset), 0.0, 1.0)
+    return np.where(now < sun.sunrise, morning, evening)
 
 
 def interpolate(alpha, min_temp, max_temp):
@@ -31,15 +116,14 @@ def interpolate(alpha, min_temp, max_temp):
 
 
 def test_illumination():
-    import astral.sun
     from astral.geocoder import lookup, database
-    from datetime import datetime, timezone
+    from datetime import date, datetime, timezone
 
     def hour(h, m):
-        return datetime(2021, 12, 25, h, m, 0).replace(tzinfo=timezone.utc)
+        return datetime(2021, 12, 25, h, m, 0).replace(tzinfo=timezone.utc).timestamp()
 
     city = lookup("Paris", database())
-    sun = astral.sun.sun(city.observer, date=hour(0, 0).date())
+    sun = Sun.of(city, date(2021, 12, 25))
 
     assert illumination(hour(2, 0), sun) == 0
     assert illumination(hour(3, 0), sun) == 0
@@ -51,3 +135,39 @@ def test_illumination():
     assert illumination(hour(16, 0), sun) < 1
     assert illumination(hour(16, 0), sun) > illumination(hour(16, 10), sun)
     assert illumination(hour(16, 10), sun) > illumination(hour(16, 20), sun)
+
+
+def test_illumination_over_two_days():
+    """Compare with the previous implementation, working on datetimes."""
+    import pytest
+    import astral.sun
+    from astral.geocoder import lookup, database
+    from datetime import date, datetime, timedelta, timezone
+
+    def reference(now, sun):
+        if now < sun["dawn"] or now > sun["dusk"]:
+            return 0.0
+        if now < sun["sunrise"]:
+            return (now - sun["dawn"]) / (sun["sunrise"] - sun["dawn"])
+        if now > sun["sunset"]:
+            return 1 - (now - sun["sunset"]) / (sun["dusk"] - sun["sunset"])
+        return 1
+
+    city = lookup("Paris", database())
+    for day in date(2021, 12, 25), date(2021, 6, 21):
+        sun = astral.sun.sun(city.observer, date=day)
+        midnight = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        for minutes in range(0, 24 * 60, 3):
+            now = midnight + timedelta(minutes=minutes)
+            assert illumination(now.timestamp(), Sun.from_astral(sun)) == (
+                pytest.approx(reference(now, sun))
+            )
+
+
+def test_illumination_array():
+    import pytest
+
+    np = pytest.importorskip("numpy")
+    sun = Sun(dawn=100.0, sunrise=200.0, sunset=1000.0, dusk=1100.0)
+    now = np.arange(0.0, 1200.0, 10.0)
+    assert list(illumination_array(now, sun)) == [illumination(t, sun) for t in now]